@@ -2,16 +2,34 @@ from __future__ import annotations
 
 import argparse
 import math
+import mmap
 import os
+import stat
 import struct
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Callable
 from pathlib import Path
 
 import numpy as np
 
 DEFAULT_FIELDS = ["x", "y", "z", "vx", "vy", "vz"]
+CONTROL_FIELDS = ("unx", "uny", "unz", "ux", "uy", "uz", "slack", "active", "constraints")
+# Interned names for the field vocabulary rphys writes; read-only memoryviews
+# hash and compare like bytes, so lookups need no copy.
+_FIELD_NAMES = {name.encode(): name for name in (*DEFAULT_FIELDS, *CONTROL_FIELDS)}
 PREFERRED_INTERACTIVE_BACKEND = "QtAgg"
+# Above this many agents the NumPy metrics path finds neighbours with a k-d tree;
+# below it the batched Gram path is faster even for tightly packed swarms.
+KDTREE_MIN_AGENTS = 128
+# Memory budget for the dense pairwise differences of a block of frames.
+PAIR_BLOCK_BYTES = 256 * 1024 * 1024
+# Approximate peak bytes per neighbour edge and per agent node while counting
+# graph components.
+GRAPH_EDGE_BYTES = 64
+GRAPH_NODE_BYTES = 32
 AXIS_LABELS_RU_SI = {
     "t": "время, с",
     "x": "координата x, м",
@@ -21,6 +39,8 @@ AXIS_LABELS_RU_SI = {
     "vy": "скорость vy, м/с",
     "vz": "скорость vz, м/с",
 }
+# Already-normalized axis names, so axis_label can skip normalize_axis.
+_AXIS_LABELS = {**AXIS_LABELS_RU_SI, "time": AXIS_LABELS_RU_SI["t"]}
 FLOCK_PARAM_FALLBACKS = {
     "neighbor_radius": 2.6,
     "separation_radius": 0.9,
@@ -29,6 +49,21 @@ FLOCK_ALPHA_PARAM_FALLBACKS = {
     "neighbor_radius": 2.6,
     "desired_distance": 1.4,
 }
+# (key, metric, title, ylabel, zero_line) in plotting order; a panel is drawn
+# only when its metric was computed.
+METRIC_PLOT_TEMPLATE = (
+    ("C", "C", "Связность", "C(t), доля", False),
+    ("R", "R", "Радиус когезии", "R(t), м", False),
+    ("E", "E", "Отклонение решетки", "E~(t), безразм.", False),
+    ("K", "K", "Несогласованность скоростей", "K~(t), м^2/с^2", False),
+    ("d_agents", "min_pair_clearance", "Мин. клиренс агент-агент", "min(d_ij - d_safe), м", True),
+    ("viol_agents", "pair_violations", "Нарушения агент-агент", "пар (d_ij < d_safe)", False),
+    ("d_obs", "min_obstacle_clearance", "Мин. клиренс до препятствий", "min(d_i - d_ob), м", True),
+    ("viol_obs", "obstacle_violations", "Нарушения препятствий", "пар (d_i < d_ob)", False),
+    ("u_dev", "u_dev_mean", "Отклонение управления", "mean ||u*-u_n||", False),
+    ("slack", "slack_mean", "Slack", "mean slack", False),
+    ("active", "active_frac", "Активные ограничения", "sum(active)/sum(total)", False),
+)
 
 @dataclass(frozen=True)
 class ObstaclePoly:
@@ -40,9 +75,17 @@ class ObstaclePoly:
     d: float
 
     def pos(self, t: np.ndarray) -> np.ndarray:
-        t = np.asarray(t, dtype=np.float64)
-        t2 = t * t
-        return self.a2[None, :] * t2[:, None] + self.a1[None, :] * t[:, None] + self.a0[None, :]
+        return _eval_poly(np.asarray(t, dtype=np.float64)[:, None], self.a2, self.a1, self.a0)
+
+
+def _eval_poly(t: np.ndarray, a2: np.ndarray, a1: np.ndarray, a0: np.ndarray) -> np.ndarray:
+    # Horner form (a2 * t + a1) * t + a0, evaluated in a single buffer; t is a
+    # (T, 1) column so callers can convert the time axis once for many polys.
+    out = a2 * t
+    out += a1
+    out *= t
+    out += a0
+    return out
 
 
 def paper_obstacles() -> list[ObstaclePoly]:
@@ -87,6 +130,15 @@ def paper_obstacles() -> list[ObstaclePoly]:
     ]
 
 
+@dataclass(frozen=True, slots=True)
+class MetricPlot:
+    key: str
+    title: str
+    ylabel: str
+    series: np.ndarray
+    zero_line: bool
+
+
 @dataclass
 class RecordMeta:
     version: int = 0
@@ -112,13 +164,52 @@ class Recording:
     fields: list[str]
     states: np.ndarray
     time: np.ndarray
+    field_to_index: dict[str, int] = field(init=False)
+    # Contiguous (agents, frames) copies of single fields, filled on demand.
+    per_axis: dict[str, np.ndarray] = field(default_factory=dict)
+
+    def __post_init__(self) -> None:
+        # First occurrence wins, matching list.index on duplicated fields.
+        self.field_to_index = {}
+        for idx, name in enumerate(self.fields):
+            self.field_to_index.setdefault(name, idx)
 
 
 class ProtoError(ValueError):
     pass
 
 
+_U64 = struct.Struct("<Q")
+_VARINT_STOP_MASK = 0x8080808080808080
+
+
 def read_varint(data: memoryview, offset: int) -> tuple[int, int]:
+    if offset >= len(data):
+        raise ProtoError("varint truncated")
+    byte = data[offset]
+    if byte < 0x80:
+        return byte, offset + 1
+    if offset + 1 < len(data) and data[offset + 1] < 0x80:
+        return (byte & 0x7F) | (data[offset + 1] << 7), offset + 2
+    if offset + 8 <= len(data):
+        # Decode up to 8 bytes at once: the lowest clear continuation bit marks
+        # the last byte, then the 7-bit groups are packed together.
+        word = _U64.unpack_from(data, offset)[0]
+        stop_bits = ~word & _VARINT_STOP_MASK
+        if stop_bits:
+            bit = stop_bits & -stop_bits
+            payload = word & (bit - 1)
+            value = (
+                (payload & 0x7F)
+                | ((payload >> 1) & (0x7F << 7))
+                | ((payload >> 2) & (0x7F << 14))
+                | ((payload >> 3) & (0x7F << 21))
+                | ((payload >> 4) & (0x7F << 28))
+                | ((payload >> 5) & (0x7F << 35))
+                | ((payload >> 6) & (0x7F << 42))
+                | ((payload >> 7) & (0x7F << 49))
+            )
+            return value, offset + (bit.bit_length() >> 3)
     value = 0
     shift = 0
     while True:
@@ -136,6 +227,10 @@ def read_varint(data: memoryview, offset: int) -> tuple[int, int]:
 
 def skip_field(data: memoryview, offset: int, wire_type: int) -> int:
     if wire_type == 0:
+        if offset + 8 <= len(data):
+            stop_bits = ~_U64.unpack_from(data, offset)[0] & _VARINT_STOP_MASK
+            if stop_bits:
+                return offset + ((stop_bits & -stop_bits).bit_length() >> 3)
         _, offset = read_varint(data, offset)
         return offset
     if wire_type == 1:
@@ -148,39 +243,43 @@ def skip_field(data: memoryview, offset: int, wire_type: int) -> int:
     raise ProtoError(f"unsupported wire type {wire_type}")
 
 
-def parse_group_color(payload: memoryview) -> tuple[int | None, str | None]:
+def read_string(data: memoryview, offset: int) -> tuple[str, int]:
+    length, offset = read_varint(data, offset)
+    end = offset + length
+    return str(data[offset:end], "utf-8", "replace"), end
+
+
+def parse_group_color(
+    payload: memoryview, start: int, end: int
+) -> tuple[int | None, str | None]:
     group = None
     color = None
-    offset = 0
-    while offset < len(payload):
+    offset = start
+    while offset < end:
         tag, offset = read_varint(payload, offset)
         field = tag >> 3
         wire_type = tag & 7
         if field == 1 and wire_type == 0:
             group, offset = read_varint(payload, offset)
         elif field == 2 and wire_type == 2:
-            length, offset = read_varint(payload, offset)
-            color = payload[offset : offset + length].tobytes().decode("utf-8", "replace")
-            offset += length
+            color, offset = read_string(payload, offset)
         else:
             offset = skip_field(payload, offset, wire_type)
     return group, color
 
 
-def parse_algorithm_param(payload: memoryview) -> tuple[str | None, float | None]:
+def parse_algorithm_param(
+    payload: memoryview, start: int, end: int
+) -> tuple[str | None, float | None]:
     key = None
     value = None
-    offset = 0
-    while offset < len(payload):
+    offset = start
+    while offset < end:
         tag, offset = read_varint(payload, offset)
         field = tag >> 3
         wire_type = tag & 7
         if field == 1 and wire_type == 2:
-            length, offset = read_varint(payload, offset)
-            key = payload[offset : offset + length].tobytes().decode(
-                "utf-8", "replace"
-            )
-            offset += length
+            key, offset = read_string(payload, offset)
         elif field == 2 and wire_type == 1:
             value = struct.unpack_from("<d", payload, offset)[0]
             offset += 8
@@ -189,89 +288,161 @@ def parse_algorithm_param(payload: memoryview) -> tuple[str | None, float | None
     return key, value
 
 
-def parse_packed_varints(payload: memoryview) -> list[int]:
+def parse_packed_varints(payload: memoryview, start: int, end: int) -> list[int]:
+    if start >= end or max(payload[start:end]) < 0x80:
+        # Every value fits in a single byte (e.g. small group ids), so the
+        # payload length equals the value count.
+        return list(payload[start:end])
     values = []
-    offset = 0
-    while offset < len(payload):
+    offset = start
+    while offset < end:
         value, offset = read_varint(payload, offset)
         values.append(value)
     return values
 
 
+def _meta_version(meta: RecordMeta, payload: memoryview, offset: int) -> int:
+    meta.version, offset = read_varint(payload, offset)
+    return offset
+
+
+def _meta_created_at(meta: RecordMeta, payload: memoryview, offset: int) -> int:
+    meta.created_at, offset = read_string(payload, offset)
+    return offset
+
+
+def _meta_dt(meta: RecordMeta, payload: memoryview, offset: int) -> int:
+    meta.dt = struct.unpack_from("<d", payload, offset)[0]
+    return offset + 8
+
+
+def _meta_stride(meta: RecordMeta, payload: memoryview, offset: int) -> int:
+    meta.stride, offset = read_varint(payload, offset)
+    return offset
+
+
+def _meta_max_frames(meta: RecordMeta, payload: memoryview, offset: int) -> int:
+    meta.max_frames, offset = read_varint(payload, offset)
+    return offset
+
+
+def _meta_model_id(meta: RecordMeta, payload: memoryview, offset: int) -> int:
+    meta.model_id, offset = read_string(payload, offset)
+    return offset
+
+
+def _meta_algorithm_id(meta: RecordMeta, payload: memoryview, offset: int) -> int:
+    meta.algorithm_id, offset = read_string(payload, offset)
+    return offset
+
+
+def _meta_plane2d(meta: RecordMeta, payload: memoryview, offset: int) -> int:
+    value, offset = read_varint(payload, offset)
+    meta.plane2d = bool(value)
+    return offset
+
+
+def _meta_agent_count(meta: RecordMeta, payload: memoryview, offset: int) -> int:
+    meta.agent_count, offset = read_varint(payload, offset)
+    return offset
+
+
+def _meta_field(meta: RecordMeta, payload: memoryview, offset: int) -> int:
+    length, offset = read_varint(payload, offset)
+    raw = payload[offset : offset + length]
+    # Writable buffers (e.g. a bytearray) give unhashable memoryviews.
+    field_name = _FIELD_NAMES.get(raw if raw.readonly else raw.tobytes())
+    if field_name is None:
+        field_name = str(raw, "utf-8", "replace")
+    meta.fields.append(field_name)
+    return offset + length
+
+
+def _meta_group_color(meta: RecordMeta, payload: memoryview, offset: int) -> int:
+    length, offset = read_varint(payload, offset)
+    group, color = parse_group_color(payload, offset, offset + length)
+    if group is not None and color is not None:
+        meta.group_colors[group] = color
+    return offset + length
+
+
+def _meta_groups(meta: RecordMeta, payload: memoryview, offset: int) -> int:
+    length, offset = read_varint(payload, offset)
+    meta.groups.extend(parse_packed_varints(payload, offset, offset + length))
+    return offset + length
+
+
+def _meta_algorithm_param(meta: RecordMeta, payload: memoryview, offset: int) -> int:
+    length, offset = read_varint(payload, offset)
+    key, value = parse_algorithm_param(payload, offset, offset + length)
+    if key is not None and value is not None:
+        meta.algorithm_params[key] = value
+    return offset + length
+
+
+# Keyed by the full tag (field << 3 | wire_type) so a field with an unexpected
+# wire type falls through to skip_field.
+_META_HANDLERS: dict[int, Callable[[RecordMeta, memoryview, int], int]] = {
+    (1 << 3) | 0: _meta_version,
+    (2 << 3) | 2: _meta_created_at,
+    (3 << 3) | 1: _meta_dt,
+    (4 << 3) | 0: _meta_stride,
+    (5 << 3) | 0: _meta_max_frames,
+    (6 << 3) | 2: _meta_model_id,
+    (7 << 3) | 2: _meta_algorithm_id,
+    (8 << 3) | 0: _meta_plane2d,
+    (9 << 3) | 0: _meta_agent_count,
+    (10 << 3) | 2: _meta_field,
+    (11 << 3) | 2: _meta_group_color,
+    (12 << 3) | 2: _meta_groups,
+    (13 << 3) | 2: _meta_algorithm_param,
+}
+
+
 def parse_record_meta(payload: memoryview) -> RecordMeta:
     meta = RecordMeta()
     offset = 0
-    while offset < len(payload):
+    end = len(payload)
+    while offset < end:
         tag, offset = read_varint(payload, offset)
-        field = tag >> 3
-        wire_type = tag & 7
-        if field == 1 and wire_type == 0:
-            meta.version, offset = read_varint(payload, offset)
-        elif field == 2 and wire_type == 2:
-            length, offset = read_varint(payload, offset)
-            meta.created_at = payload[offset : offset + length].tobytes().decode(
-                "utf-8", "replace"
-            )
-            offset += length
-        elif field == 3 and wire_type == 1:
-            meta.dt = struct.unpack_from("<d", payload, offset)[0]
-            offset += 8
-        elif field == 4 and wire_type == 0:
-            meta.stride, offset = read_varint(payload, offset)
-        elif field == 5 and wire_type == 0:
-            meta.max_frames, offset = read_varint(payload, offset)
-        elif field == 6 and wire_type == 2:
-            length, offset = read_varint(payload, offset)
-            meta.model_id = payload[offset : offset + length].tobytes().decode(
-                "utf-8", "replace"
-            )
-            offset += length
-        elif field == 7 and wire_type == 2:
-            length, offset = read_varint(payload, offset)
-            meta.algorithm_id = payload[offset : offset + length].tobytes().decode(
-                "utf-8", "replace"
-            )
-            offset += length
-        elif field == 8 and wire_type == 0:
-            value, offset = read_varint(payload, offset)
-            meta.plane2d = bool(value)
-        elif field == 9 and wire_type == 0:
-            meta.agent_count, offset = read_varint(payload, offset)
-        elif field == 10 and wire_type == 2:
-            length, offset = read_varint(payload, offset)
-            field_name = payload[offset : offset + length].tobytes().decode(
-                "utf-8", "replace"
-            )
-            meta.fields.append(field_name)
-            offset += length
-        elif field == 11 and wire_type == 2:
-            length, offset = read_varint(payload, offset)
-            group, color = parse_group_color(payload[offset : offset + length])
-            if group is not None and color is not None:
-                meta.group_colors[group] = color
-            offset += length
-        elif field == 12 and wire_type == 2:
-            length, offset = read_varint(payload, offset)
-            meta.groups.extend(parse_packed_varints(payload[offset : offset + length]))
-            offset += length
-        elif field == 13 and wire_type == 2:
-            length, offset = read_varint(payload, offset)
-            key, value = parse_algorithm_param(payload[offset : offset + length])
-            if key is not None and value is not None:
-                meta.algorithm_params[key] = value
-            offset += length
+        handler = _META_HANDLERS.get(tag)
+        if handler is not None:
+            offset = handler(meta, payload, offset)
         else:
-            offset = skip_field(payload, offset, wire_type)
+            offset = skip_field(payload, offset, tag & 7)
     return meta
 
 
-def parse_recording(data: bytes) -> tuple[RecordMeta, int, np.ndarray]:
+_RecordingFields = tuple[memoryview | None, int, memoryview | None]
+
+
+def _parse_recording_canonical(view: memoryview) -> _RecordingFields | None:
+    # rphys writes [meta][frame_count][states] in field order; read that layout
+    # directly and leave anything else to the generic tag loop.
+    end = len(view)
+    if end == 0 or view[0] != 0x0A:
+        return None
+    length, offset = read_varint(view, 1)
+    meta_payload = view[offset : offset + length]
+    offset += length
+    if offset >= end or view[offset] != 0x10:
+        return None
+    frame_count, offset = read_varint(view, offset + 1)
+    if offset >= end or view[offset] != 0x1A:
+        return None
+    length, offset = read_varint(view, offset + 1)
+    if offset + length != end:
+        return None
+    return meta_payload, frame_count, view[offset:end]
+
+
+def _parse_recording_fields(view: memoryview) -> _RecordingFields:
     meta_payload = None
     frame_count = 0
     states_payload = None
-    view = memoryview(data)
     offset = 0
-    while offset < len(view):
+    end = len(view)
+    while offset < end:
         tag, offset = read_varint(view, offset)
         field = tag >> 3
         wire_type = tag & 7
@@ -287,6 +458,15 @@ def parse_recording(data: bytes) -> tuple[RecordMeta, int, np.ndarray]:
             offset += length
         else:
             offset = skip_field(view, offset, wire_type)
+    return meta_payload, frame_count, states_payload
+
+
+def parse_recording(data: bytes | mmap.mmap) -> tuple[RecordMeta, int, np.ndarray]:
+    view = memoryview(data)
+    fields = _parse_recording_canonical(view)
+    if fields is None:
+        fields = _parse_recording_fields(view)
+    meta_payload, frame_count, states_payload = fields
 
     meta = parse_record_meta(meta_payload) if meta_payload else RecordMeta()
 
@@ -298,8 +478,24 @@ def parse_recording(data: bytes) -> tuple[RecordMeta, int, np.ndarray]:
     return meta, frame_count, states
 
 
+def map_recording_file(path: Path) -> bytes | mmap.mmap:
+    # The states array is a zero-copy view of the mapping, which stays alive
+    # for as long as the array references it. Pipes and other non-regular
+    # files report size 0 and cannot be mapped, so they are read instead.
+    with open(path, "rb") as fh:
+        st = os.fstat(fh.fileno())
+        if not stat.S_ISREG(st.st_mode):
+            return fh.read()
+        if st.st_size == 0:
+            return b""
+        try:
+            return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return fh.read()
+
+
 def build_recording(path: Path) -> Recording:
-    meta, frame_count, states = parse_recording(path.read_bytes())
+    meta, frame_count, states = parse_recording(map_recording_file(path))
     if meta.fields:
         fields = [f.strip().lower() for f in meta.fields if f.strip()]
     else:
@@ -338,7 +534,7 @@ def build_recording(path: Path) -> Recording:
         print("warning: dt missing; using 1.0 с", file=sys.stderr)
     if meta.stride <= 0:
         print("warning: stride missing; using 1", file=sys.stderr)
-    time = np.arange(frame_count, dtype=np.float64) * dt * stride
+    time = np.arange(frame_count, dtype=np.float32) * np.float32(dt * stride)
 
     return Recording(meta, frame_count, agent_count, fields, states, time)
 
@@ -351,10 +547,12 @@ def normalize_axis(name: str) -> str:
 
 
 def axis_label(axis: str) -> str:
-    axis = normalize_axis(axis)
-    label = AXIS_LABELS_RU_SI.get(axis)
+    label = _AXIS_LABELS.get(axis)
     if label is None:
-        raise ProtoError(f"unknown axis '{axis}'")
+        axis = normalize_axis(axis)
+        label = AXIS_LABELS_RU_SI.get(axis)
+        if label is None:
+            raise ProtoError(f"unknown axis '{axis}'")
     return label
 
 
@@ -370,27 +568,45 @@ def axis_series(recording: Recording, axis: str, agent: int) -> np.ndarray:
     axis = normalize_axis(axis)
     if axis == "t":
         return recording.time
-    if axis not in recording.fields:
+    index = recording.field_to_index.get(axis)
+    if index is None:
         raise ProtoError(f"axis '{axis}' not found in recording fields")
-    index = recording.fields.index(axis)
     return recording.states[:, agent, index]
 
 
-def field_index(fields: list[str], name: str) -> int | None:
-    try:
-        return fields.index(name)
-    except ValueError:
-        return None
+def axis_series_all(recording: Recording, axis: str) -> np.ndarray:
+    axis = normalize_axis(axis)
+    if axis == "t":
+        return np.broadcast_to(
+            recording.time, (recording.agent_count, recording.frame_count)
+        )
+    values = recording.per_axis.get(axis)
+    if values is None:
+        index = recording.field_to_index.get(axis)
+        if index is None:
+            raise ProtoError(f"axis '{axis}' not found in recording fields")
+        values = np.ascontiguousarray(recording.states[:, :, index].T)
+        recording.per_axis[axis] = values
+    return values
+
+
+def take_fields(states: np.ndarray, indices: list[int]) -> np.ndarray:
+    # Consecutive fields (the usual x, y, z / vx, vy, vz layout) are a plain
+    # slice, which is a view; anything else needs a fancy-indexed copy.
+    start = indices[0]
+    if indices == list(range(start, start + len(indices))):
+        return states[:, :, start : start + len(indices)]
+    return states[:, :, indices]
 
 
 def extract_state_vectors(recording: Recording) -> tuple[np.ndarray, np.ndarray, int]:
-    fields = recording.fields
-    x_idx = field_index(fields, "x")
-    y_idx = field_index(fields, "y")
-    z_idx = field_index(fields, "z")
-    vx_idx = field_index(fields, "vx")
-    vy_idx = field_index(fields, "vy")
-    vz_idx = field_index(fields, "vz")
+    field_to_index = recording.field_to_index
+    x_idx = field_to_index.get("x")
+    y_idx = field_to_index.get("y")
+    z_idx = field_to_index.get("z")
+    vx_idx = field_to_index.get("vx")
+    vy_idx = field_to_index.get("vy")
+    vz_idx = field_to_index.get("vz")
 
     if x_idx is None or y_idx is None:
         raise ProtoError("позиции x/y отсутствуют в записи")
@@ -411,8 +627,8 @@ def extract_state_vectors(recording: Recording) -> tuple[np.ndarray, np.ndarray,
         pos_fields.append(z_idx)
         vel_fields.append(vz_idx)
 
-    positions = recording.states[:, :, pos_fields]
-    velocities = recording.states[:, :, vel_fields]
+    positions = take_fields(recording.states, pos_fields)
+    velocities = take_fields(recording.states, vel_fields)
     dim = 2 if is_2d else 3
     return positions, velocities, dim
 
@@ -498,10 +714,193 @@ def resolve_metric_params(
     return float(neighbor_radius), float(desired_distance)
 
 
+def _make_pair_kernel(prange: Callable) -> Callable:
+    # Called by load_pair_kernel once numba is imported, so numba.prange is
+    # bound as a closure variable instead of through module state.
+    def pair_kernel(
+        positions: np.ndarray,
+        r2: float,
+        desired_distance: float,
+        d_safe2: float,
+        out_E: np.ndarray,
+        out_C: np.ndarray,
+        out_min: np.ndarray,
+        out_violations: np.ndarray,
+    ) -> None:
+        # One sweep over the pairs of each frame feeds both the flock metrics
+        # (neighbours within r2) and the safety metrics (closest pair, pairs
+        # closer than d_safe2). Pass r2 < 0 or d_safe2 = 0 to skip either side.
+        frame_count, agent_count, dim = positions.shape
+        for frame in prange(frame_count):
+            pos = positions[frame]
+            parents = np.arange(agent_count)
+            components = agent_count
+            energy = 0.0
+            min_d2 = math.inf
+            violations = 0
+            for i in range(agent_count):
+                for j in range(i + 1, agent_count):
+                    dist2 = 0.0
+                    for k in range(dim):
+                        diff = float(pos[i, k]) - float(pos[j, k])
+                        dist2 += diff * diff
+                    if dist2 < min_d2:
+                        min_d2 = dist2
+                    if dist2 < d_safe2:
+                        violations += 1
+                    if dist2 > r2:
+                        continue
+                    delta = math.sqrt(dist2) - desired_distance
+                    energy += delta * delta
+
+                    ra = i
+                    while parents[ra] != ra:
+                        parents[ra] = parents[parents[ra]]
+                        ra = parents[ra]
+                    rb = j
+                    while parents[rb] != rb:
+                        parents[rb] = parents[parents[rb]]
+                        rb = parents[rb]
+                    if ra != rb:
+                        parents[rb] = ra
+                        components -= 1
+            out_E[frame] = energy
+            if agent_count <= 1:
+                out_C[frame] = 1.0
+            else:
+                out_C[frame] = (agent_count - components) / (agent_count - 1)
+            out_min[frame] = math.sqrt(min_d2)
+            out_violations[frame] = violations
+
+    return pair_kernel
+
+
+@lru_cache(maxsize=1)
+def load_pair_kernel() -> Callable | None:
+    # numba and scipy are only imported once metrics are requested, so --info
+    # and --list-axes do not pay for them.
+    try:
+        import numba
+    except ImportError:  # numba is optional; metrics fall back to NumPy
+        return None
+    return numba.njit(parallel=True, fastmath=True, cache=True)(
+        _make_pair_kernel(numba.prange)
+    )
+
+
+def run_pair_kernel(
+    positions: np.ndarray, r2: float, desired_distance: float, d_safe2: float
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray] | None:
+    pair_kernel = load_pair_kernel()
+    if pair_kernel is None:
+        return None
+    frame_count = positions.shape[0]
+    outputs = tuple(np.zeros(frame_count, dtype=np.float64) for _ in range(4))
+    pair_kernel(np.ascontiguousarray(positions), r2, desired_distance, d_safe2, *outputs)
+    return outputs
+
+
+def _count_components(
+    src: np.ndarray, dst: np.ndarray, frame_count: int, agent_count: int
+) -> np.ndarray:
+    # Frames are disjoint blocks of one graph, so components never span frames
+    # and the distinct labels within each block give its component count.
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    nodes = frame_count * agent_count
+    graph = csr_matrix((np.ones(len(src)), (src, dst)), shape=(nodes, nodes))
+    _, labels = connected_components(graph, directed=False)
+    labels = np.sort(labels.reshape(frame_count, agent_count), axis=1)
+    return 1 + np.count_nonzero(np.diff(labels, axis=1), axis=1)
+
+
+def _flock_pair_metrics(
+    positions: np.ndarray, neighbor_radius: float, desired_distance: float
+) -> tuple[np.ndarray, np.ndarray]:
+    frame_count, agent_count, _ = positions.shape
+    r2 = neighbor_radius * neighbor_radius
+    energy = np.zeros(frame_count, dtype=np.float64)
+    components = np.zeros(frame_count, dtype=np.int64)
+
+    if agent_count > KDTREE_MIN_AGENTS and frame_count > 0:
+        from scipy.spatial import cKDTree
+
+        # Neighbour pairs of a block of frames, offset into one block-diagonal
+        # graph so its components are counted in a single pass. The block is
+        # flushed once its graph would exceed PAIR_BLOCK_BYTES, which keeps
+        # memory flat however long the recording is.
+        src = []
+        dst = []
+        edge_count = 0
+        block_start = 0
+        for frame in range(frame_count):
+            pos = positions[frame]
+            pairs = cKDTree(pos).query_pairs(neighbor_radius, output_type="ndarray")
+            i, j = pairs[:, 0], pairs[:, 1]
+            diff = pos[i] - pos[j]
+            dist = np.sqrt(np.einsum("ij,ij->i", diff, diff))
+            energy[frame] = ((dist - desired_distance) ** 2).sum()
+            offset = (frame - block_start) * agent_count
+            src.append(i + offset)
+            dst.append(j + offset)
+            edge_count += len(pairs)
+            block_frames = frame + 1 - block_start
+            graph_bytes = (
+                edge_count * GRAPH_EDGE_BYTES
+                + block_frames * agent_count * GRAPH_NODE_BYTES
+            )
+            if frame == frame_count - 1 or graph_bytes >= PAIR_BLOCK_BYTES:
+                components[block_start : frame + 1] = _count_components(
+                    np.concatenate(src), np.concatenate(dst), block_frames, agent_count
+                )
+                src.clear()
+                dst.clear()
+                edge_count = 0
+                block_start = frame + 1
+        return energy, components
+
+    # Squared distances from the Gram matrix, |a|^2 + |b|^2 - 2 a.b, in blocks of
+    # frames that fit in PAIR_BLOCK_BYTES. Callers pass positions centred per
+    # frame, which keeps the cancellation error small.
+    iu, ju = np.triu_indices(agent_count, k=1)
+    block = max(1, min(frame_count, PAIR_BLOCK_BYTES // (agent_count * agent_count * 8)))
+    gram_buf = np.empty((block, agent_count, agent_count), dtype=np.float64)
+    pos_buf = np.empty((block, agent_count, positions.shape[2]), dtype=np.float64)
+    sq_buf = np.empty((block, agent_count), dtype=np.float64)
+    for start in range(0, frame_count, block):
+        chunk = positions[start : start + block]
+        count = len(chunk)
+        pos = pos_buf[:count]
+        np.copyto(pos, chunk)
+        sq = np.einsum("fij,fij->fi", pos, pos, out=sq_buf[:count])
+        d2 = np.matmul(pos, pos.transpose(0, 2, 1), out=gram_buf[:count])
+        d2 *= -2.0
+        d2 += sq[:, :, None]
+        d2 += sq[:, None, :]
+        np.maximum(d2, 0.0, out=d2)
+        pair_d2 = d2[:, iu, ju]
+        f, p = np.nonzero(pair_d2 <= r2)
+        dist = np.sqrt(pair_d2[f, p])
+        energy[start : start + count] = np.bincount(
+            f, weights=(dist - desired_distance) ** 2, minlength=count
+        )
+        components[start : start + count] = _count_components(
+            f * agent_count + iu[p], f * agent_count + ju[p], count, agent_count
+        )
+    return energy, components
+
+
 def compute_flock_metrics(
-    recording: Recording, neighbor_radius: float, desired_distance: float
+    recording: Recording,
+    neighbor_radius: float,
+    desired_distance: float,
+    pair_metrics: tuple[np.ndarray, np.ndarray] | None = None,
+    state_vectors: tuple[np.ndarray, np.ndarray, int] | None = None,
 ) -> dict[str, np.ndarray]:
-    positions, velocities, _ = extract_state_vectors(recording)
+    if state_vectors is None:
+        state_vectors = extract_state_vectors(recording)
+    positions, velocities, _ = state_vectors
     frame_count = recording.frame_count
     agent_count = recording.agent_count
     if agent_count <= 0:
@@ -511,64 +910,27 @@ def compute_flock_metrics(
     r2 = neighbor_radius * neighbor_radius
     d2 = desired_distance * desired_distance
 
-    cohesion_radius = np.zeros(frame_count, dtype=np.float64)
-    velocity_mismatch = np.zeros(frame_count, dtype=np.float64)
-    deviation_energy = np.zeros(frame_count, dtype=np.float64)
-    connectivity = np.zeros(frame_count, dtype=np.float64)
-
-    for frame in range(frame_count):
-        pos = positions[frame]
-        vel = velocities[frame]
-        center = pos.mean(axis=0)
-        v_center = vel.mean(axis=0)
-
-        offsets = pos - center
-        cohesion_radius[frame] = np.linalg.norm(offsets, axis=1).max()
-
-        v_offsets = vel - v_center
-        velocity_mismatch[frame] = 0.5 * float(np.sum(v_offsets * v_offsets))
-
-        parents = list(range(agent_count))
-        ranks = [0] * agent_count
-
-        def find_root(x: int) -> int:
-            while parents[x] != x:
-                parents[x] = parents[parents[x]]
-                x = parents[x]
-            return x
-
-        def union(a: int, b: int) -> None:
-            ra = find_root(a)
-            rb = find_root(b)
-            if ra == rb:
-                return
-            if ranks[ra] < ranks[rb]:
-                parents[ra] = rb
-            elif ranks[ra] > ranks[rb]:
-                parents[rb] = ra
-            else:
-                parents[rb] = ra
-                ranks[ra] += 1
-
-        energy = 0.0
-        for i in range(agent_count):
-            pi = pos[i]
-            for j in range(i + 1, agent_count):
-                diff = pi - pos[j]
-                dist2 = float(np.dot(diff, diff))
-                if dist2 <= r2:
-                    union(i, j)
-                    dist = math.sqrt(dist2)
-                    delta = dist - desired_distance
-                    energy += delta * delta
-
-        deviation_energy[frame] = energy
-        roots = {find_root(i) for i in range(agent_count)}
-        components = len(roots)
+    positions = positions.astype(np.float32, copy=False)
+    velocities = velocities.astype(np.float32, copy=False)
+    offsets = positions - positions.mean(axis=1, keepdims=True)
+    v_offsets = velocities - velocities.mean(axis=1, keepdims=True)
+    cohesion_radius = np.sqrt(np.einsum("fij,fij->fi", offsets, offsets).max(axis=1))
+    velocity_mismatch = 0.5 * np.einsum("fij,fij->f", v_offsets, v_offsets, dtype=np.float64)
+
+    if pair_metrics is None:
+        kernel_out = run_pair_kernel(positions, r2, desired_distance, 0.0)
+        if kernel_out is not None:
+            pair_metrics = kernel_out[0], kernel_out[1]
+    if pair_metrics is not None:
+        deviation_energy, connectivity = pair_metrics
+    else:
+        deviation_energy, components = _flock_pair_metrics(
+            offsets, neighbor_radius, desired_distance
+        )
         if agent_count <= 1:
-            connectivity[frame] = 1.0
+            connectivity = np.ones(frame_count, dtype=np.float64)
         else:
-            connectivity[frame] = (agent_count - components) / (agent_count - 1)
+            connectivity = (agent_count - components) / (agent_count - 1)
 
     velocity_mismatch /= agent_count
     if d2 > 0:
@@ -622,16 +984,13 @@ def resolve_safety_params(
 
 
 def compute_control_metrics(recording: Recording) -> dict[str, np.ndarray]:
-    fields = recording.fields
-    idx = {name: field_index(fields, name) for name in (
-        "unx", "uny", "unz", "ux", "uy", "uz", "slack", "active", "constraints"
-    )}
+    idx = {name: recording.field_to_index.get(name) for name in CONTROL_FIELDS}
     missing = [k for k, v in idx.items() if v is None]
     if missing:
         return {}
 
-    un = recording.states[:, :, [idx["unx"], idx["uny"], idx["unz"]]]
-    u = recording.states[:, :, [idx["ux"], idx["uy"], idx["uz"]]]
+    un = take_fields(recording.states, [idx["unx"], idx["uny"], idx["unz"]])
+    u = take_fields(recording.states, [idx["ux"], idx["uy"], idx["uz"]])
     du = u - un
     du_norm = np.linalg.norm(du, axis=2)
 
@@ -654,10 +1013,50 @@ def compute_control_metrics(recording: Recording) -> dict[str, np.ndarray]:
     }
 
 
+def _safety_pair_metrics(
+    positions: np.ndarray, d_safe2: float
+) -> tuple[np.ndarray, np.ndarray]:
+    frame_count, agent_count, dim = positions.shape
+    min_distance = np.zeros(frame_count, dtype=np.float64)
+    violations = np.zeros(frame_count, dtype=np.float64)
+
+    # Batched Gram-matrix distances over blocks of frames, on positions centred
+    # per frame to keep the cancellation error small.
+    centered = positions - positions.mean(axis=1, keepdims=True)
+    diag = np.arange(agent_count)
+    block = max(1, min(frame_count, PAIR_BLOCK_BYTES // (agent_count * agent_count * 8)))
+    gram_buf = np.empty((block, agent_count, agent_count), dtype=np.float64)
+    pos_buf = np.empty((block, agent_count, dim), dtype=np.float64)
+    sq_buf = np.empty((block, agent_count), dtype=np.float64)
+    for start in range(0, frame_count, block):
+        chunk = centered[start : start + block]
+        count = len(chunk)
+        pos = pos_buf[:count]
+        np.copyto(pos, chunk)
+        sq = np.einsum("fij,fij->fi", pos, pos, out=sq_buf[:count])
+        d2 = np.matmul(pos, pos.transpose(0, 2, 1), out=gram_buf[:count])
+        d2 *= -2.0
+        d2 += sq[:, :, None]
+        d2 += sq[:, None, :]
+        np.maximum(d2, 0.0, out=d2)
+        d2[:, diag, diag] = np.inf
+        min_distance[start : start + count] = np.sqrt(d2.min(axis=(1, 2)))
+        # d2 is symmetric with an infinite diagonal, so every violating pair
+        # is counted exactly twice.
+        violations[start : start + count] = 0.5 * (d2 < d_safe2).sum(axis=(1, 2))
+    return min_distance, violations
+
+
 def compute_safety_metrics(
-    recording: Recording, agent_safe_distance: float, obstacles: list[ObstaclePoly] | None
+    recording: Recording,
+    agent_safe_distance: float,
+    obstacles: list[ObstaclePoly] | None,
+    pair_metrics: tuple[np.ndarray, np.ndarray] | None = None,
+    state_vectors: tuple[np.ndarray, np.ndarray, int] | None = None,
 ) -> dict[str, np.ndarray]:
-    positions, _, dim = extract_state_vectors(recording)
+    if state_vectors is None:
+        state_vectors = extract_state_vectors(recording)
+    positions, _, dim = state_vectors
     frame_count = recording.frame_count
     agent_count = recording.agent_count
     if agent_count <= 1:
@@ -666,19 +1065,15 @@ def compute_safety_metrics(
     d_safe = float(agent_safe_distance)
     d_safe2 = d_safe * d_safe
 
-    min_pair_clearance = np.zeros(frame_count, dtype=np.float64)
-    pair_violations = np.zeros(frame_count, dtype=np.float64)
-
-    for frame in range(frame_count):
-        pos = positions[frame]  # (N,dim)
-        g = pos @ pos.T
-        sq = np.sum(pos * pos, axis=1)
-        d2 = sq[:, None] + sq[None, :] - 2.0 * g
-        d2[d2 < 0] = 0.0
-        np.fill_diagonal(d2, np.inf)
-        min_d2 = float(np.min(d2))
-        min_pair_clearance[frame] = math.sqrt(min_d2) - d_safe
-        pair_violations[frame] = float(np.sum(np.triu(d2 < d_safe2, 1)))
+    if pair_metrics is None:
+        kernel_out = run_pair_kernel(positions, -1.0, 0.0, d_safe2)
+        if kernel_out is not None:
+            pair_metrics = kernel_out[2], kernel_out[3]
+    if pair_metrics is not None:
+        min_pair_distance, pair_violations = pair_metrics
+    else:
+        min_pair_distance, pair_violations = _safety_pair_metrics(positions, d_safe2)
+    min_pair_clearance = min_pair_distance - d_safe
 
     out: dict[str, np.ndarray] = {
         "t": recording.time,
@@ -688,16 +1083,30 @@ def compute_safety_metrics(
 
     if obstacles:
         time = recording.time
-        min_ob_clearance = np.full(frame_count, math.inf, dtype=np.float64)
+        min_ob_clearance = np.zeros(frame_count, dtype=np.float64)
         ob_violations = np.zeros(frame_count, dtype=np.float64)
 
-        for ob in obstacles:
-            p_ob = ob.pos(time)[:, :dim]
-            diff = positions - p_ob[:, None, :]
-            dist = np.linalg.norm(diff, axis=2)
-            clearance = dist - float(ob.d)
-            min_ob_clearance = np.minimum(min_ob_clearance, np.min(clearance, axis=1))
-            ob_violations += np.sum(clearance < 0.0, axis=1).astype(np.float64)
+        # All obstacles at once: (T, K, dim) centres against (T, N, dim) agents.
+        # Centres and radii follow the float32 positions so the (T, K, N, dim)
+        # differences are not promoted to float64.
+        t = np.asarray(time, dtype=np.float64)[:, None]
+        p_ob = np.stack(
+            [_eval_poly(t, ob.a2, ob.a1, ob.a0)[:, :dim] for ob in obstacles], axis=1
+        )
+        p_ob = p_ob.astype(positions.dtype, copy=False)
+        radii = np.array([float(ob.d) for ob in obstacles], dtype=positions.dtype)
+        radii2 = radii * radii
+        block_bytes = len(obstacles) * agent_count * dim * positions.itemsize
+        block = max(1, min(frame_count, PAIR_BLOCK_BYTES // block_bytes))
+        for start in range(0, frame_count, block):
+            stop = start + block
+            diff = positions[start:stop, None, :, :] - p_ob[start:stop, :, None, :]
+            dist2 = np.einsum("fkij,fkij->fki", diff, diff)
+            # Violations only need the sign, so compare squares; sqrt is taken
+            # once per (frame, obstacle) on the closest agent.
+            ob_violations[start:stop] = (dist2 < radii2[:, None]).sum(axis=(1, 2))
+            clearance = np.sqrt(dist2.min(axis=2)) - radii
+            min_ob_clearance[start:stop] = clearance.min(axis=1)
 
         out["min_obstacle_clearance"] = min_ob_clearance
         out["obstacle_violations"] = ob_violations
@@ -705,6 +1114,48 @@ def compute_safety_metrics(
     return out
 
 
+def compute_all_metrics(
+    recording: Recording,
+    neighbor_radius: float,
+    desired_distance: float,
+    agent_safe_distance: float,
+    obstacles: list[ObstaclePoly] | None,
+) -> tuple[dict[str, np.ndarray], dict[str, np.ndarray], dict[str, np.ndarray]]:
+    # The state vectors are extracted once for both metric sets; with numba,
+    # the flock and safety pair metrics also come from one sweep over them.
+    state_vectors = extract_state_vectors(recording)
+    positions = state_vectors[0]
+    flock_pairs = None
+    safety_pairs = None
+    if recording.agent_count > 1:
+        d_safe = float(agent_safe_distance)
+        kernel_out = run_pair_kernel(
+            positions.astype(np.float32, copy=False),
+            neighbor_radius * neighbor_radius,
+            desired_distance,
+            d_safe * d_safe,
+        )
+        if kernel_out is not None:
+            flock_pairs = kernel_out[0], kernel_out[1]
+            safety_pairs = kernel_out[2], kernel_out[3]
+    flock = compute_flock_metrics(
+        recording,
+        neighbor_radius,
+        desired_distance,
+        pair_metrics=flock_pairs,
+        state_vectors=state_vectors,
+    )
+    safety = compute_safety_metrics(
+        recording,
+        agent_safe_distance,
+        obstacles,
+        pair_metrics=safety_pairs,
+        state_vectors=state_vectors,
+    )
+    control = compute_control_metrics(recording)
+    return flock, safety, control
+
+
 def print_info(path: Path, recording: Recording) -> None:
     meta = recording.meta
     print(f"Файл: {path}")
@@ -805,6 +1256,32 @@ def ensure_dir(path: Path) -> None:
     path.mkdir(parents=True, exist_ok=True)
 
 
+def png_save_options(out_path: Path) -> dict:
+    # zlib level 1 encodes several times faster than the default 6 for a
+    # somewhat larger file; dropping the Software tag skips a metadata chunk.
+    if out_path.suffix.lower() not in ("", ".png"):
+        return {}
+    return {"pil_kwargs": {"compress_level": 1}, "metadata": {"Software": None}}
+
+
+def fixed_layout(fig, rows: int, cols: int, top: float) -> None:
+    # Saved figures have a known size, so margins are fixed in inches (sized
+    # for tick labels, axis labels and panel titles) instead of running the
+    # tight_layout solver, which takes ~0.2 s on the metrics grid.
+    left, right, bottom, wgap, hgap = 0.8, 0.15, 0.6, 0.8, 0.65
+    width, height = fig.get_size_inches()
+    axis_width = (width - left - right - (cols - 1) * wgap) / cols
+    axis_height = (height - bottom - top - (rows - 1) * hgap) / rows
+    fig.subplots_adjust(
+        left=left / width,
+        right=1 - right / width,
+        bottom=bottom / height,
+        top=1 - top / height,
+        wspace=wgap / axis_width,
+        hspace=hgap / axis_height,
+    )
+
+
 def save_metric_plot(
     *,
     out_path: Path,
@@ -815,9 +1292,12 @@ def save_metric_plot(
     zero_line: bool,
     dpi: int,
 ) -> None:
-    import matplotlib.pyplot as plt
+    from matplotlib.figure import Figure
 
-    fig, ax = plt.subplots(figsize=(9, 5.4))
+    # A standalone Figure (no pyplot state), so several can be saved from
+    # worker threads at once.
+    fig = Figure(figsize=(9, 5.4))
+    ax = fig.subplots()
     ax.plot(t, y, linewidth=1.6)
     ax.set_title(title)
     ax.set_xlabel("время, с")
@@ -825,9 +1305,8 @@ def save_metric_plot(
     ax.grid(True, alpha=0.3)
     if zero_line:
         ax.axhline(0.0, color="#ff6b6b", linewidth=1.2, alpha=0.5)
-    fig.tight_layout()
-    fig.savefig(out_path, dpi=dpi)
-    plt.close(fig)
+    fixed_layout(fig, 1, 1, top=0.4)
+    fig.savefig(out_path, dpi=dpi, **png_save_options(out_path))
 
 
 def save_split_metric_plots(
@@ -836,7 +1315,7 @@ def save_split_metric_plots(
     out_dir: Path | None,
     prefix: str | None,
     dpi: int,
-    plots: list[tuple[str, str, str, np.ndarray, bool]],
+    plots: list[MetricPlot],
     t: np.ndarray,
 ) -> Path:
     # Default next to input .pb so results stay with the experiment.
@@ -844,18 +1323,25 @@ def save_split_metric_plots(
     ensure_dir(target_dir)
     name_prefix = prefix or file_path.stem
 
-    for key, title, ylabel, series, zero_line in plots:
-        safe_key = "".join(ch if ch.isalnum() or ch in ("-", "_") else "_" for ch in key)
-        out_path = target_dir / f"{name_prefix}-{safe_key}.png"
-        save_metric_plot(
-            out_path=out_path,
-            t=t,
-            y=series,
-            title=title,
-            ylabel=ylabel,
-            zero_line=zero_line,
-            dpi=dpi,
-        )
+    with ThreadPoolExecutor(max_workers=min(8, len(plots) or 1)) as pool:
+        futures = []
+        for plot in plots:
+            safe_key = "".join(ch if ch.isalnum() or ch in ("-", "_") else "_" for ch in plot.key)
+            out_path = target_dir / f"{name_prefix}-{safe_key}.png"
+            futures.append(
+                pool.submit(
+                    save_metric_plot,
+                    out_path=out_path,
+                    t=t,
+                    y=plot.series,
+                    title=plot.title,
+                    ylabel=plot.ylabel,
+                    zero_line=plot.zero_line,
+                    dpi=dpi,
+                )
+            )
+        for future in futures:
+            future.result()
 
     return target_dir
 
@@ -898,49 +1384,83 @@ def try_set_backend(backend: str, verbose: bool) -> bool:
         return False
 
 
-def is_non_interactive_backend() -> bool:
-    try:
-        import matplotlib
-    except Exception:
-        return False
-    backend_name = matplotlib.get_backend().lower()
+@lru_cache(maxsize=1)
+def non_interactive_backends() -> frozenset[str]:
     try:
         from matplotlib.backends import backend_registry, BackendFilter
 
         non_interactive = backend_registry.list_builtin(
             BackendFilter.NON_INTERACTIVE
         )
-        return backend_name in {name.lower() for name in non_interactive}
+        return frozenset(name.lower() for name in non_interactive)
     except Exception:
         try:
             from matplotlib import rcsetup
 
-            return backend_name in {name.lower() for name in rcsetup.non_interactive_bk}
+            return frozenset(name.lower() for name in rcsetup.non_interactive_bk)
         except Exception:
-            return False
+            return frozenset()
+
+
+def is_non_interactive_backend() -> bool:
+    # Not cached itself: the answer changes whenever a backend is switched.
+    try:
+        import matplotlib
+    except Exception:
+        return False
+    return matplotlib.get_backend().lower() in non_interactive_backends()
+
+
+# Only Linux without a display server counts as headless; settled once per
+# process.
+_HEADLESS = sys.platform.startswith("linux") and not (
+    os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY")
+)
 
 
 def is_headless() -> bool:
-    if sys.platform.startswith("linux"):
-        if os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY"):
-            return False
-        return True
-    return False
+    return _HEADLESS
 
 
 def pick_default_out(base_name: str = "rphys-plot.png") -> Path:
-    base = Path.cwd() / base_name
-    if not base.exists():
-        return base
+    cwd = Path.cwd()
+    # One directory listing instead of a stat() per candidate name.
+    with os.scandir(cwd) as entries:
+        existing = {entry.name for entry in entries}
+    if base_name not in existing:
+        return cwd / base_name
+    base = Path(base_name)
     stem = base.stem
     suffix = base.suffix or ".png"
     for idx in range(1, 1000):
-        candidate = Path.cwd() / f"{stem}-{idx}{suffix}"
-        if not candidate.exists():
-            return candidate
+        name = f"{stem}-{idx}{suffix}"
+        if name not in existing:
+            return cwd / name
     raise ProtoError("unable to find a free filename for output plot")
 
 
+def fallback_out_path() -> Path:
+    out_path = pick_default_out()
+    print(
+        "Предупреждение: интерактивное окно недоступно, "
+        f"сохраняю график в файл {out_path}",
+        file=sys.stderr,
+    )
+    return out_path
+
+
+def decide_backend(args: argparse.Namespace, headless: bool) -> tuple[str, Path | None]:
+    # Everything that can be settled without importing matplotlib; whether the
+    # chosen backend actually loads is checked by the caller.
+    out_path = args.out
+    if out_path is None and headless:
+        out_path = fallback_out_path()
+    backend = normalize_backend_name(args.backend)
+    if backend is None:
+        backend = "Agg" if out_path is not None else PREFERRED_INTERACTIVE_BACKEND
+    return backend, out_path
+
+
 def main(argv: list[str] | None = None) -> None:
     args = parse_args(argv)
     neighbor_radius = None
@@ -965,8 +1485,9 @@ def main(argv: list[str] | None = None) -> None:
         else:
             x_axis = normalize_axis(args.x)
             y_axis = normalize_axis(args.y)
-            axis_label(x_axis)
-            axis_label(y_axis)
+            # Also validates both axis names before anything is plotted.
+            x_label = axis_label(x_axis)
+            y_label = axis_label(y_axis)
 
             if not args.all and (args.agent < 0 or args.agent >= recording.agent_count):
                 raise ProtoError(
@@ -976,79 +1497,41 @@ def main(argv: list[str] | None = None) -> None:
         print(f"Ошибка: {exc}", file=sys.stderr)
         sys.exit(1)
 
-    headless = is_headless()
-    out_path = args.out
-    if out_path is None and headless:
-        out_path = pick_default_out()
-        print(
-            "Предупреждение: интерактивное окно недоступно, "
-            f"сохраняю график в файл {out_path}",
-            file=sys.stderr,
-        )
-
-    backend_choice = normalize_backend_name(args.backend)
-    if backend_choice:
-        if not try_set_backend(backend_choice, verbose=True) and out_path is None:
-            out_path = pick_default_out()
-            print(
-                "Предупреждение: интерактивное окно недоступно, "
-                f"сохраняю график в файл {out_path}",
-                file=sys.stderr,
-            )
-            try_set_backend("Agg", verbose=False)
-    elif out_path is not None:
+    backend, out_path = decide_backend(args, is_headless())
+    explicit = normalize_backend_name(args.backend) is not None
+    if backend == "Agg":
+        # Picked up by the first matplotlib import, which then skips probing
+        # for an interactive backend.
+        os.environ.setdefault("MPLBACKEND", "Agg")
+    if not try_set_backend(backend, verbose=explicit) and explicit and out_path is None:
+        out_path = fallback_out_path()
         try_set_backend("Agg", verbose=False)
-    else:
-        try_set_backend(PREFERRED_INTERACTIVE_BACKEND, verbose=False)
 
-    if out_path is None and (is_non_interactive_backend() or headless):
-        out_path = pick_default_out()
-        print(
-            "Предупреждение: интерактивное окно недоступно, "
-            f"сохраняю график в файл {out_path}",
-            file=sys.stderr,
-        )
+    if out_path is None and is_non_interactive_backend():
+        out_path = fallback_out_path()
         try_set_backend("Agg", verbose=False)
 
     import matplotlib.pyplot as plt
+    from matplotlib.collections import LineCollection
 
     if args.metrics:
-        metrics = compute_flock_metrics(
+        d_safe, obstacles = resolve_safety_params(
+            recording, args.agent_safe_distance, args.scenario
+        )
+        metrics, safety, control = compute_all_metrics(
             recording,
             neighbor_radius if neighbor_radius is not None else 0.0,
             desired_distance if desired_distance is not None else 0.0,
+            d_safe,
+            obstacles,
         )
-        d_safe, obstacles = resolve_safety_params(
-            recording, args.agent_safe_distance, args.scenario
-        )
-        safety = compute_safety_metrics(recording, d_safe, obstacles)
-        control = compute_control_metrics(recording)
-
-        plots: list[tuple[str, str, str, np.ndarray, bool]] = []
-        plots.append(("C", "Связность", "C(t), доля", metrics["C"], False))
-        plots.append(("R", "Радиус когезии", "R(t), м", metrics["R"], False))
-        plots.append(("E", "Отклонение решетки", "E~(t), безразм.", metrics["E"], False))
-        plots.append(("K", "Несогласованность скоростей", "K~(t), м^2/с^2", metrics["K"], False))
-
-        if safety:
-            plots.append(
-                ("d_agents", "Мин. клиренс агент-агент", "min(d_ij - d_safe), м", safety["min_pair_clearance"], True)
-            )
-            plots.append(
-                ("viol_agents", "Нарушения агент-агент", "пар (d_ij < d_safe)", safety["pair_violations"], False)
-            )
-            if "min_obstacle_clearance" in safety:
-                plots.append(
-                    ("d_obs", "Мин. клиренс до препятствий", "min(d_i - d_ob), м", safety["min_obstacle_clearance"], True)
-                )
-                plots.append(
-                    ("viol_obs", "Нарушения препятствий", "пар (d_i < d_ob)", safety["obstacle_violations"], False)
-                )
 
-        if control:
-            plots.append(("u_dev", "Отклонение управления", "mean ||u*-u_n||", control["u_dev_mean"], False))
-            plots.append(("slack", "Slack", "mean slack", control["slack_mean"], False))
-            plots.append(("active", "Активные ограничения", "sum(active)/sum(total)", control["active_frac"], False))
+        values = {**metrics, **safety, **control}
+        plots = [
+            MetricPlot(key, title, ylabel, values[name], zero_line)
+            for key, name, title, ylabel, zero_line in METRIC_PLOT_TEMPLATE
+            if name in values
+        ]
 
         if args.split_metrics:
             # Always save; avoid opening interactive windows.
@@ -1064,51 +1547,63 @@ def main(argv: list[str] | None = None) -> None:
             return
 
         cols = 2 if len(plots) <= 6 else 3
-        rows = int(math.ceil(len(plots) / cols))
-        fig, axes = plt.subplots(rows, cols, figsize=(5.2 * cols, 3.0 * rows), sharex=True)
-        axes = np.array(axes).ravel()
-
-        t = metrics["t"]
-        for idx, (_, title, ylabel, series, zero_line) in enumerate(plots):
-            ax = axes[idx]
-            ax.plot(t, series, linewidth=1.4)
-            ax.set_title(title)
-            ax.set_ylabel(ylabel)
-            if zero_line:
-                ax.axhline(0.0, color="#ff6b6b", linewidth=1.0, alpha=0.45)
-            ax.set_xlabel("время, с")
-            ax.grid(True, alpha=0.3)
+        rows = -(-len(plots) // cols)
+        # Shared styling goes through rc_context so the loop below only adds
+        # data, without changing matplotlib's global defaults.
+        with plt.rc_context({"axes.grid": True, "grid.alpha": 0.3, "lines.linewidth": 1.4}):
+            fig, axes = plt.subplots(
+                rows, cols, figsize=(5.2 * cols, 3.0 * rows), sharex=True
+            )
+            axes = np.atleast_1d(axes).ravel()
+
+            t = metrics["t"]
+            for ax, plot in zip(axes, plots):
+                ax.plot(t, plot.series)
+                ax.set(title=plot.title, xlabel="время, с", ylabel=plot.ylabel)
+                if plot.zero_line:
+                    ax.axhline(0.0, color="#ff6b6b", linewidth=1.0, alpha=0.45)
 
         for ax in axes[len(plots):]:
             ax.axis("off")
 
         if args.title:
             fig.suptitle(args.title)
+        if out_path:
+            fixed_layout(fig, rows, cols, top=0.7 if args.title else 0.4)
+        elif args.title:
             fig.tight_layout(rect=[0, 0, 1, 0.96])
         else:
             fig.tight_layout()
     else:
         fig, ax = plt.subplots(figsize=(9, 5.4))
         if args.all:
-            for agent in range(recording.agent_count):
-                x_data = axis_series(recording, x_axis, agent)
-                y_data = axis_series(recording, y_axis, agent)
-                ax.plot(x_data, y_data, alpha=0.35, linewidth=1)
+            segments = np.stack(
+                [axis_series_all(recording, x_axis), axis_series_all(recording, y_axis)],
+                axis=-1,
+            )
+            colors = plt.rcParams["axes.prop_cycle"].by_key()["color"]
+            ax.add_collection(
+                LineCollection(segments, colors=colors, alpha=0.35, linewidths=1)
+            )
+            ax.autoscale_view()
         else:
             x_data = axis_series(recording, x_axis, args.agent)
             y_data = axis_series(recording, y_axis, args.agent)
             ax.plot(x_data, y_data, linewidth=1.6, label=f"агент {args.agent}")
             ax.legend(loc="best")
 
-        ax.set_xlabel(axis_label(x_axis))
-        ax.set_ylabel(axis_label(y_axis))
+        ax.set_xlabel(x_label)
+        ax.set_ylabel(y_label)
         if args.title:
             ax.set_title(args.title)
         ax.grid(True, alpha=0.3)
-        fig.tight_layout()
+        if out_path:
+            fixed_layout(fig, 1, 1, top=0.4 if args.title else 0.2)
+        else:
+            fig.tight_layout()
 
     if out_path:
-        fig.savefig(out_path, dpi=args.dpi)
+        fig.savefig(out_path, dpi=args.dpi, **png_save_options(out_path))
         print(f"Сохранено: {out_path}")
     else:
         plt.show()